@@ -3,104 +3,234 @@
 from __future__ import annotations
 
 import argparse
+import atexit
+import contextlib
+import functools
+import importlib.util
+import io
+import logging
 import os
 import subprocess
 import sys
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from types import ModuleType
+
+logger = logging.getLogger(__name__)
+
+_EXECUTOR: ProcessPoolExecutor | None = None
+# The (compare_script, max_workers) that _EXECUTOR was created with.
+_EXECUTOR_CONFIG: tuple[str, int | None] | None = None
+# The compare script, imported into each worker process by _init_worker.
+_COMPARE_MODULE: ModuleType | None = None
+
+_HW_COMPARISON_DIRNAME = "Xbox__Xbox__DirectX__nv2a"
+# compare.py writes HW comparisons to <output_dir>/<xemu_version>/<platform>/<gl_info>/<glsl_info>/<golden_id>.
+# This must be kept in sync with ResultsInfo.output_subdirectory in compare.py.
+_HW_COMPARISON_DEPTH = 5
+
+
+def _scan(path: str, marker: str) -> tuple[list[str], bool]:
+    """Returns the subdirectories of `path` and whether `path` directly contains a `marker` file."""
+    subdirs: list[str] = []
+    has_marker = False
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name == marker:
+                has_marker = True
+    return subdirs, has_marker
+
+
+def _iter_dirs_with(marker: str, root: str) -> Iterator[str]:
+    """Yields directories under `root` that contain a `marker` file and at least one subdirectory.
+
+    Subdirectories of a yielded directory are not visited. A missing `root` is treated as empty.
+    """
+    if not os.path.isdir(root):
+        return
 
+    pending = [root]
 
-def _find_results_paths(results_dir: str) -> set[str]:
-    ret: set[str] = set()
+    while pending:
+        current = pending.pop()
+        subdirs, has_marker = _scan(current, marker)
 
-    for root, dirnames, filenames in os.walk(results_dir):
-        if not dirnames:
+        if has_marker and subdirs:
+            # No need to recurse into test suite directories.
+            yield current
             continue
 
-        if "results.json" not in filenames:
-            continue
+        pending.extend(subdirs)
 
-        ret.add(root)
 
-        # No need to recurse into test suite directories.
-        dirnames.clear()
-
-    return ret
+def _iter_results_paths(results_dir: str) -> Iterator[str]:
+    return _iter_dirs_with("results.json", results_dir)
 
 
 def _find_hw_comparison_paths(output_dir: str) -> set[str]:
+    """Finds HW comparison directories, only descending as deep as compare.py places them."""
     ret: set[str] = set()
+    if not os.path.isdir(output_dir):
+        return ret
 
-    for root, dirnames, filenames in os.walk(output_dir):
-        if not dirnames:
-            continue
+    pending: deque[tuple[str, int]] = deque([(output_dir, 0)])
+    while pending:
+        current, depth = pending.popleft()
 
-        if "summary.json" not in filenames:
+        if depth < _HW_COMPARISON_DEPTH:
+            subdirs, _ = _scan(current, "summary.json")
+            pending.extend((subdir, depth + 1) for subdir in subdirs)
             continue
 
-        if os.path.basename(root) != "Xbox__Xbox__DirectX__nv2a":
+        if os.path.basename(current) != _HW_COMPARISON_DIRNAME:
             continue
-        ret.add(root)
 
-        # No need to recurse into test suite directories.
-        dirnames.clear()
+        subdirs, has_summary = _scan(current, "summary.json")
+        if has_summary and subdirs:
+            ret.add(current)
 
     return ret
 
 
 def _comparison_path_to_source_path(comparison_path: str) -> str:
-    components = comparison_path.split("/")
-
-    xemu = components[-4]
-    platform = components[-3]
-    graphics_pair = components[-2]
+    head, _ = os.path.split(comparison_path)
+    head, graphics_pair = os.path.split(head)
+    head, platform = os.path.split(head)
+    _, xemu = os.path.split(head)
 
     return os.path.join(xemu, platform, *graphics_pair.split(":"))
 
 
 def find_result_dirs_without_hw_diffs(results_dir: str, output_dir: str) -> set[str]:
-    result_paths = _find_results_paths(results_dir)
+    source_paths = {
+        os.path.join(results_dir, _comparison_path_to_source_path(path))
+        for path in _find_hw_comparison_paths(output_dir)
+    }
+
+    return {path for path in _iter_results_paths(results_dir) if path not in source_paths}
+
+
+def _init_worker(compare_script: str) -> None:
+    """Imports the compare script into the worker process so comparisons can be run without a subprocess."""
+    global _COMPARE_MODULE  # noqa: PLW0603 Using the global statement
+
+    try:
+        spec = importlib.util.spec_from_file_location("compare", compare_script)
+        if not spec or not spec.loader:
+            return
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except Exception:
+        logger.warning("Failed to import %s, comparisons will be run as subprocesses", compare_script, exc_info=True)
+        return
+
+    _COMPARE_MODULE = module
+
+
+def _run_compare_in_process(compare_module: ModuleType, args: list[str]) -> tuple[int, str, str]:
+    """Runs the compare script's entrypoint in this process. Returns tuple[ExitCode, STDOUT, STDERR]."""
+    stdout = io.StringIO()
+    stderr = io.StringIO()
 
-    hw_comparison_paths = _find_hw_comparison_paths(output_dir)
-    source_paths = {os.path.join(results_dir, _comparison_path_to_source_path(path)) for path in hw_comparison_paths}
+    # compare.py configures logging via basicConfig, which only takes effect if the root logger has no handlers. Clear
+    # them so its log output is written to the redirected stderr, then restore the original configuration afterwards.
+    root_logger = logging.getLogger()
+    saved_handlers = root_logger.handlers[:]
+    saved_level = root_logger.level
+    root_logger.handlers.clear()
 
-    return result_paths - source_paths
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            returncode = compare_module._process_arguments_and_run(args)  # noqa: SLF001 Private member accessed
+    except SystemExit as err:
+        if err.code is None:
+            returncode = 0
+        else:
+            returncode = err.code if isinstance(err.code, int) else 1
+    except Exception:  # noqa: BLE001 Do not catch blind exception
+        stderr.write(traceback.format_exc())
+        returncode = 1
+    finally:
+        root_logger.handlers[:] = saved_handlers
+        root_logger.setLevel(saved_level)
+
+    return returncode or 0, stdout.getvalue(), stderr.getvalue()
 
 
 def perform_comparison(result: str, output_dir: str, compare_script: str) -> tuple[str, bool, str, str]:
-    process = subprocess.run(
-        [compare_script, result, "--output-dir", output_dir, "--verbose"], capture_output=True, text=True, check=False
-    )
+    args = [result, "--output-dir", output_dir, "--verbose"]
+
+    if _COMPARE_MODULE is not None:
+        returncode, stdout, stderr = _run_compare_in_process(_COMPARE_MODULE, args)
+        return result, returncode == 0, stdout, stderr
+
+    process = subprocess.run([compare_script, *args], capture_output=True, text=True, check=False)
     if process.returncode == 0:
         return result, True, process.stdout, process.stderr
     return result, False, process.stdout, process.stderr
 
 
+def _get_executor(compare_script: str, max_workers: int | None = None) -> ProcessPoolExecutor:
+    """Returns the shared process pool, creating it on first use."""
+    global _EXECUTOR, _EXECUTOR_CONFIG  # noqa: PLW0603 Using the global statement
+
+    config = (compare_script, max_workers)
+    if _EXECUTOR is not None and config != _EXECUTOR_CONFIG:
+        # Workers import the compare script at startup, so a different script requires a new pool.
+        _shutdown_executor()
+
+    if _EXECUTOR is None:
+        _EXECUTOR = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(compare_script,))
+        _EXECUTOR_CONFIG = config
+    return _EXECUTOR
+
+
+def _shutdown_executor() -> None:
+    global _EXECUTOR, _EXECUTOR_CONFIG  # noqa: PLW0603 Using the global statement
+
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown()
+        _EXECUTOR = None
+        _EXECUTOR_CONFIG = None
+
+
+atexit.register(_shutdown_executor)
+
+
 def generate_missing_hw_diffs(
     results_dir: str, output_dir: str, compare_script: str, max_workers: int | None = None
-) -> None:
+) -> tuple[int, int]:
+    """Runs the compare script for every result without a HW comparison. Returns tuple[NumSucceeded, NumFailed]."""
     results_missing_comparisons = find_result_dirs_without_hw_diffs(results_dir, output_dir)
 
     if not results_missing_comparisons:
-        return
+        return 0, 0
 
     successful_comparisons = 0
     failed_comparisons = 0
 
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = {
-            executor.submit(perform_comparison, result, output_dir, compare_script): result
-            for result in results_missing_comparisons
-        }
+    executor = _get_executor(compare_script, max_workers)
+    num_workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(results_missing_comparisons) // (num_workers * 4))
+    compare = functools.partial(perform_comparison, output_dir=output_dir, compare_script=compare_script)
 
-        for future in as_completed(futures):
-            result_path, success, stdout, stderr = future.result()
-            if success:
-                successful_comparisons += 1
-            else:
-                failed_comparisons += 1
+    for result_path, success, stdout, stderr in executor.map(compare, results_missing_comparisons, chunksize=chunksize):
+        if success:
+            successful_comparisons += 1
+            logger.info("Generated HW comparison for %s", result_path)
+            logger.debug("%s", stdout)
+        else:
+            failed_comparisons += 1
+            logger.error("Failed to generate HW comparison for %s\n%s\n%s", result_path, stdout, stderr)
 
-    for result in results_missing_comparisons:
-        subprocess.run([compare_script, result, "--output-dir", output_dir, "--verbose"], check=False)
+    return successful_comparisons, failed_comparisons
 
 
 def main() -> int:
@@ -123,8 +253,13 @@ def main() -> int:
 
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO)
+
     compare_script = os.path.abspath(os.path.expanduser(args.compare_script))
-    generate_missing_hw_diffs(args.results_dir, args.output_dir, compare_script)
+    successful_comparisons, failed_comparisons = generate_missing_hw_diffs(
+        args.results_dir, args.output_dir, compare_script
+    )
+    logger.info("Generated %d HW comparisons, %d failed", successful_comparisons, failed_comparisons)
 
     return 0
 
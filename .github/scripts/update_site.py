@@ -7,19 +7,52 @@ from __future__ import annotations
 
 import argparse
 import dataclasses
-import glob
 import json
 import os
 import re
 import sys
+import tempfile
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
-from jinja2 import Environment, FileSystemLoader
+import orjson
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
+if TYPE_CHECKING:
+    from collections.abc import Iterator
 
-@dataclass
+# Number of threads used to overlap independent I/O-bound site generation steps.
+_MAX_WORKERS = 4
+
+# Matches diff image filenames, capturing the name of the golden image without its extension.
+_DIFF_RE = re.compile(r"^(.+)-diff\.png$")
+
+
+def _iter_png(root: str) -> Iterator[str]:
+    """Yields the path of every non-hidden .png file under `root`, relative to `root`."""
+    if not os.path.isdir(root):
+        return
+
+    pending = [""]
+
+    while pending:
+        rel_dir = pending.pop()
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            for entry in it:
+                name = entry.name
+                if name.startswith("."):
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(f"{rel_dir}{name}{os.path.sep}")
+                elif name.endswith(".png") and entry.is_file(follow_symlinks=False):
+                    yield rel_dir + name
+
+
+@dataclass(slots=True)
 class DiffLink:
     # Info about the test artifact.
     filename: str
@@ -44,18 +77,19 @@ class DiffLink:
 
     known_issues: list[str] = dataclasses.field(default_factory=list)
 
-    @property
-    def sort_key(self) -> str:
-        return f"{self.suite}/{self.filename}"
+    # Derived from the test artifact info above.
+    sort_key: str = dataclasses.field(init=False)
+    test_name: str = dataclasses.field(init=False)
+
+    def __post_init__(self):
+        self.sort_key = f"{self.suite}/{self.filename}"
+        self.test_name = self.filename[:-4]
 
     @property
     def has_diff(self) -> bool:
+        # Diff images are attached after construction, so this cannot be precomputed.
         return bool(self.hw_diff_image or self.xemu_diff_image)
 
-    @property
-    def test_name(self) -> str:
-        return self.filename[:-4]
-
     def add_known_issues(self, registry: dict[str, Any]):
         known_issues = registry.get(self.suite)
         if not known_issues:
@@ -122,7 +156,6 @@ class Generator:
         self,
         *,
         branch: str,
-        results_dir: str,
         hw_golden_comparison: str,
         xemu_golden_comparison: str,
         results_base_url: str,
@@ -134,7 +167,6 @@ class Generator:
         top_index_only: bool,
     ):
         self.branch = branch
-        self.results_dir = results_dir
         self.hw_golden_comparison = hw_golden_comparison
         self.xemu_golden_comparison = xemu_golden_comparison
         self.results_base_url = results_base_url
@@ -149,48 +181,77 @@ class Generator:
         self.comparison_registry: dict[str, str] = {}
         self.run_infos: dict[str, dict[str, Any]] = defaultdict(lambda: {})
 
+        self._output_basename = os.path.basename(self.output_dir)
+        self._hw_diff_url_prefix = self._make_site_url(f"{hw_golden_comparison.replace(self.output_dir, '')}/")
+        self._xemu_diff_url_prefix = self._make_site_url(f"{xemu_golden_comparison.replace(self.output_dir, '')}/")
+        self._results_url_prefix = f"{results_base_url}/results/"
+        self._hw_golden_url_prefix = f"{hw_golden_base_url}/results/"
+        self._xemu_golden_url_prefix = f"{xemu_golden_base_url}/results/"
+
         self.results: dict[str, DiffLink] = {}
+        self._results_lock = threading.Lock()
         if not self.top_index_only:
-            self._find_results()
-            self._find_hw_diffs()
-            self._load_comparison_registry()
-            self._find_xemu_diffs()
-
-    def _find_results(self):
-        for result in glob.glob("**/*.png", root_dir=self.results_dir, recursive=True):
-            components = result.split(os.path.sep)
-            suite, filename = components[-2:]
-            machine, gl, glsl = components[-5:-2]
-            diff_key = os.path.join(suite, filename)
-            self.results[diff_key] = DiffLink(
-                filename=filename,
+            # The HW and xemu comparison trees are independent, so they are walked concurrently.
+            with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+                hw_diffs = executor.submit(self._find_hw_diffs)
+                xemu_diffs = executor.submit(self._find_xemu_diffs_with_registry)
+                hw_diffs.result()
+                xemu_diffs.result()
+
+            # Insertion order depends on thread timing, so normalize it to keep the generated page deterministic.
+            self.results = dict(sorted(self.results.items()))
+
+    def _get_or_create_diff(self, run_components: list[str], suite: str, golden_filename: str) -> DiffLink:
+        """Returns the DiffLink for the given result, creating it if necessary.
+
+        `run_components` are the xemu_version/os_arch/gl_info/glsl_info path components of the results run. They are
+        part of the key so that diffs from different runs of the same test are never merged into one DiffLink.
+        """
+        result = "/".join([*run_components[:4], suite, golden_filename])
+        with self._results_lock:
+            diff_link = self.results.get(result)
+            if diff_link is not None:
+                return diff_link
+
+            machine, gl, glsl = run_components[1:4]
+            diff_link = DiffLink(
+                filename=golden_filename,
                 suite=suite,
                 machine=machine,
                 gl=gl,
                 glsl=glsl,
-                result_url=f"{self.results_base_url}/results/{result}",
+                result_url=self._results_url_prefix + result,
             )
+            self.results[result] = diff_link
+            return diff_link
 
     def _home_url(self, output_dir: str) -> str:
         return f"{os.path.relpath(self.output_dir, output_dir)}/index.html"
 
     def _make_site_url(self, path: str) -> str:
-        return f"{self.site_resources_base_url}/{os.path.basename(self.output_dir)}/{path}"
+        return f"{self.site_resources_base_url}/{self._output_basename}/{path}"
 
     def _find_hw_diffs(self):
-        hw_diff_relative_path = self.hw_golden_comparison.replace(self.output_dir, "")
-        for hw_diff in glob.glob("**/*.png", root_dir=self.hw_golden_comparison, recursive=True):
-            suite, filename = hw_diff.split(os.path.sep)[-2:]
-            golden_filename = filename.replace("-diff.png", ".png")
-            diff_link = self.results[os.path.join(suite, golden_filename)]
+        hw_diff_url_prefix = self._hw_diff_url_prefix
+        hw_golden_url_prefix = self._hw_golden_url_prefix
+        sep = os.path.sep
+
+        for hw_diff in _iter_png(self.hw_golden_comparison):
+            components = hw_diff.split(sep)
+            suite, filename = components[-2:]
+            match = _DIFF_RE.match(filename)
+            if not match:
+                continue
+            golden_filename = match.group(1) + ".png"
+            diff_link = self._get_or_create_diff(components, suite, golden_filename)
 
             diff_link.hw_diff_image = hw_diff
-            diff_link.hw_diff_url = self._make_site_url(f"{hw_diff_relative_path}/{hw_diff}")
-            diff_link.hw_golden_url = f"{self.hw_golden_base_url}/results/{suite}/{golden_filename}"
+            diff_link.hw_diff_url = hw_diff_url_prefix + hw_diff
+            diff_link.hw_golden_url = hw_golden_url_prefix + diff_link.sort_key
 
     def _load_comparison_registry(self):
-        with open(os.path.join(self.xemu_golden_comparison, "comparisons.json")) as infile:
-            self.comparison_registry = json.load(infile)
+        with open(os.path.join(self.xemu_golden_comparison, "comparisons.json"), "rb") as infile:
+            self.comparison_registry = orjson.loads(infile.read())
 
         for comparison in self.comparison_registry:
             run_info_file = os.path.join(comparison, "run_info.json")
@@ -202,33 +263,55 @@ class Generator:
                     run_info = json.load(infile)
                     self.run_infos[run_info_file] = run_info
 
+    def _find_xemu_diffs_with_registry(self):
+        self._load_comparison_registry()
+        self._find_xemu_diffs()
+
     def _find_xemu_diffs(self):
-        xemu_diff_relative_path = self.xemu_golden_comparison.replace(self.output_dir, "")
+        xemu_diff_url_prefix = self._xemu_diff_url_prefix
+        xemu_golden_url_prefix = self._xemu_golden_url_prefix
+        hw_golden_url_prefix = self._hw_golden_url_prefix
+        sep = os.path.sep
 
-        for xemu_diff in glob.glob("**/*.png", root_dir=self.xemu_golden_comparison, recursive=True):
-            components = xemu_diff.split(os.path.sep)
-            # The first 4 components of the path will be xemu_version/os_arch/gl_info/glsl_info
-            results_key = os.path.join("results", *components[:4])
+        # Many diffs share the same run prefix, so the registry lookup is only done once per distinct prefix.
+        xemu_subpaths: dict[tuple[str, ...], str] = {}
 
-            xemu_golden_info = self.comparison_registry.get(results_key)
-            if not xemu_golden_info:
-                msg = f"Failed to lookup comparison database for xemu diff '{xemu_diff}' from {self.comparison_registry}"
-                raise ValueError(msg)
+        for xemu_diff in _iter_png(self.xemu_golden_comparison):
+            components = xemu_diff.split(sep)
             suite, filename = components[-2:]
-            golden_filename = filename.replace("-diff.png", ".png")
-            diff_link = self.results[os.path.join(suite, golden_filename)]
+            match = _DIFF_RE.match(filename)
+            if not match:
+                continue
+            golden_filename = match.group(1) + ".png"
+
+            # The first 4 components of the path will be xemu_version/os_arch/gl_info/glsl_info
+            prefix = tuple(components[:4])
+
+            xemu_subpath = xemu_subpaths.get(prefix)
+            if xemu_subpath is None:
+                results_key = os.path.join("results", *prefix)
+                xemu_golden_info = self.comparison_registry.get(results_key)
+                if not xemu_golden_info:
+                    msg = (
+                        f"Failed to lookup comparison database for xemu diff '{xemu_diff}' from "
+                        f"{self.comparison_registry}"
+                    )
+                    raise ValueError(msg)
+                xemu_subpath = "/".join(xemu_golden_info.split(os.path.sep)[2:])
+                xemu_subpaths[prefix] = xemu_subpath
+
+            diff_link = self._get_or_create_diff(components, suite, golden_filename)
 
-            xemu_subpath = "/".join(xemu_golden_info.split(os.path.sep)[2:])
             diff_link.xemu_build_info = xemu_subpath
             diff_link.xemu_diff_image = xemu_diff
-            diff_link.xemu_diff_url = self._make_site_url(f"{xemu_diff_relative_path}/{xemu_diff}")
+            diff_link.xemu_diff_url = xemu_diff_url_prefix + xemu_diff
 
-            diff_link.xemu_golden_url = f"{self.xemu_golden_base_url}/results/{xemu_subpath}/{suite}/{golden_filename}"
+            diff_link.xemu_golden_url = f"{xemu_golden_url_prefix}{xemu_subpath}/{diff_link.sort_key}"
 
             # If the results are identical to HW, there will be no golden. Since the Pages page has the room, populate
             # the Golden image anyway.
             if not diff_link.hw_golden_url:
-                diff_link.hw_golden_url = f"{self.hw_golden_base_url}/results/{suite}/{golden_filename}"
+                diff_link.hw_golden_url = hw_golden_url_prefix + diff_link.sort_key
 
     def _generate_comparison_page(self):
         output_dir = os.path.join(self.output_dir, self.branch.replace("/", "_"))
@@ -240,13 +323,20 @@ class Generator:
         known_issues_file = os.path.join(self.xemu_golden_comparison, "known_issues.json")
         known_issues_registry = _load_known_issues(known_issues_file) if os.path.isfile(known_issues_file) else {}
 
-        diffs_by_xemu_version: dict[str, dict[str, list[DiffLink]]] = defaultdict(lambda: defaultdict(list))
+        diffs_by_xemu_version: dict[str, dict[str, list[DiffLink]]] = {}
 
-        for diff in self.results.values():
+        results = self.results.values()
+        for diff in results:
             if not diff.xemu_diff_url:
                 continue
             diff.add_known_issues(known_issues_registry)
-            diffs_by_xemu_version[diff.xemu_build_info][diff.suite].append(diff)
+            suites = diffs_by_xemu_version.setdefault(diff.xemu_build_info, {})
+            suites.setdefault(diff.suite, []).append(diff)
+
+        # Sort once here rather than within the template. Like Jinja's sort filter, the ordering is case-insensitive.
+        for suites in diffs_by_xemu_version.values():
+            for diffs in suites.values():
+                diffs.sort(key=lambda diff: diff.test_name.lower())
 
         with open(os.path.join(output_dir, "index.html"), "w") as outfile:
             template_file = "comparison_result.html.j2" if diffs_by_xemu_version else "no_diffs_result.html.j2"
@@ -265,10 +355,11 @@ class Generator:
     def _generate_index_page(self):
         comparison_pages: dict[str, str] = {}
 
-        for page in glob.glob("**/index.html", root_dir=self.output_dir, recursive=True):
-            if page == "index.html":
-                continue
-            comparison_pages[os.path.dirname(page)] = page
+        # Each comparison page lives directly within a per-branch subdirectory of the output dir.
+        with os.scandir(self.output_dir) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False) and os.path.isfile(os.path.join(entry.path, "index.html")):
+                    comparison_pages[entry.name] = f"{entry.name}/index.html"
 
         index_template = self.env.get_template("index.html.j2")
         output_dir = self.output_dir
@@ -298,10 +389,14 @@ class Generator:
             outfile.write(css_template.render())
 
     def generate_site(self) -> int:
-        self._write_css()
-        self._write_js()
-        if not self.top_index_only:
-            self._generate_comparison_page()
+        with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+            tasks = [executor.submit(self._write_css), executor.submit(self._write_js)]
+            if not self.top_index_only:
+                tasks.append(executor.submit(self._generate_comparison_page))
+            for task in tasks:
+                task.result()
+
+        # The index links to the comparison pages, so it must be generated after them.
         self._generate_index_page()
         return 0
 
@@ -333,11 +428,6 @@ def main() -> int:
         help="Directory containing the comparison between the results and xemu goldens",
     )
     parser.add_argument("results_branch", help="Name of the branch containing the results")
-    parser.add_argument(
-        "--results-dir",
-        default="results",
-        help="Directory including test outputs that will be processed",
-    )
     parser.add_argument(
         "--output-dir",
         default="site",
@@ -367,6 +457,11 @@ def main() -> int:
         "--templates-dir",
         help="Directory containing the templates used to render the site.",
     )
+    parser.add_argument(
+        "--template-cache-dir",
+        default=os.path.join(tempfile.gettempdir(), "jinja_cache"),
+        help="Directory in which compiled templates are cached between runs.",
+    )
     parser.add_argument(
         "--top-index-only",
         action="store_true",
@@ -375,7 +470,6 @@ def main() -> int:
 
     args = parser.parse_args()
 
-    results_dir = args.results_dir
     output_dir = os.path.abspath(os.path.expanduser(args.output_dir))
     hw_golden_comparison = os.path.abspath(os.path.expanduser(args.hw_comparison_results))
     xemu_golden_comparison = os.path.abspath(os.path.expanduser(args.xemu_comparison_results))
@@ -393,12 +487,19 @@ def main() -> int:
     if not args.templates_dir:
         args.templates_dir = os.path.join(os.path.dirname(__file__), "site-templates")
 
-    jinja_env = Environment(loader=FileSystemLoader(args.templates_dir))
+    template_cache_dir = os.path.abspath(os.path.expanduser(args.template_cache_dir))
+    os.makedirs(template_cache_dir, exist_ok=True)
+
+    jinja_env = Environment(
+        loader=FileSystemLoader(args.templates_dir),
+        bytecode_cache=FileSystemBytecodeCache(directory=template_cache_dir, pattern="%s.cache"),
+        auto_reload=False,
+        cache_size=-1,
+    )
     jinja_env.globals["sidenav_width"] = 48
     jinja_env.globals["sidenav_icon_width"] = 32
 
     generator = Generator(
-        results_dir=results_dir,
         hw_golden_comparison=hw_golden_comparison,
         xemu_golden_comparison=xemu_golden_comparison,
         branch=args.results_branch,
@@ -11,7 +11,7 @@ from collections import defaultdict
 from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(slots=True)
 class DiffLink:
     filename: str
     suite: str
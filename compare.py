@@ -299,7 +299,7 @@ def _discover_results(results_root: str) -> list[str]:
     return [os.path.join(results_root, os.path.dirname(file)) for file in results_files]
 
 
-def _process_arguments_and_run():
+def _process_arguments_and_run(argv: list[str] | None = None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--verbose",
@@ -343,7 +343,7 @@ def _process_arguments_and_run():
         help="Use LPIPS to pre-filter diffs before perceptualdiff.",
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.list:
         local_results = _discover_results(args.results)